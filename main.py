@@ -6,19 +6,27 @@ import argparse
 def main():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument("filename")
+    arg_parser.add_argument("--no-dedup", dest="dedup", action="store_false",
+                            help="не отбрасывать повторные строки с уже встреченным ID запроса")
+    arg_parser.add_argument("-j", "--workers", type=int, default=1,
+                            help="количество процессов для параллельного парсинга (только вместе с --no-dedup)")
     args = arg_parser.parse_args()
+    if args.workers > 1 and args.dedup:
+        arg_parser.error("параллельный парсинг (-j > 1) возможен только с --no-dedup")
     file = Path(args.filename)
-    parser = Parser(file)
-    parser.parse()
+    parser = Parser(file, dedup=args.dedup)
+    if args.workers > 1:
+        parser.parse_parallel(args.workers)
+    else:
+        parser.parse()
 
     # IPs
     print("Все клиенты сервиса (IP-адреса):", parser.valid_ips, "\nКоличество валидных IP-адресов:", len(parser.valid_ips))
     invalid_ips = set()
     ports = set()
     for ip in parser.invalid_ips:
-        invalid_split = ip.split(".")
-        invalid_ip = '.'.join(invalid_split[0:3])
-        ports.add(invalid_split[3])
+        invalid_ip, _, port = ip.rpartition(".")
+        ports.add(port)
         invalid_ips.add(invalid_ip)
     print("Количество невалидных IP-адресов:", len(parser.invalid_ips),
           "\nНевалидные IP-адреса с уникальными первыми тремя октетами:", invalid_ips,
@@ -27,9 +35,9 @@ def main():
           "\nКоличество предположительных портов невалидных IP-адресов:", len(ports))
 
     # Requests
-    most_popular_request = parser.most_popular_request()
+    most_popular_request, most_popular_count = parser.most_popular_request() or (None, 0)
     print("Самый популярный запрос:", most_popular_request, "\nКоличество запросов (самый популярный запрос):",
-          parser.request_freq[most_popular_request] if most_popular_request else 0)
+          most_popular_count)
 
     # Words
     print("Среднее количество слов в запросах:", parser.average_words())
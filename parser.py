@@ -1,136 +1,319 @@
 from pathlib import Path
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from ipaddress import IPv4Address
-from typing import Dict, Optional, Set, Tuple
+from itertools import repeat
+import mmap
+import stat
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 import re
 
+# Внутренняя метка времени, упакованная в целое число yymmddhhmiss: числа сравниваются так же, как `datetime`
+Timestamp = int
+# Буфер, по которому идёт поиск: отображённый в память файл или прочитанный блок
+Buffer = Union[bytes, mmap.mmap]
+# Начальные значения первой/последней метки времени, пока не встречено ни одной
+NO_FIRST_TIME: Timestamp = 2 ** 63
+NO_LAST_TIME: Timestamp = 0
 
-class Parser:
-    # Регулярное выражение для внутренней метки времени формата: [dd.mm.yy hh:mm:ss]
-    INTERNAL_TIMESTAMP = re.compile(r"\[(\d{2})\.(\d{2})\.(\d{2}) (\d{2}:\d{2}:\d{2})]")
 
+class Parser:
+    # Октет IPv4: десятичное число 0-255 без ведущих нулей
+    _IPV4_OCTET = rb"(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)"
     # Регулярное выражение для строки подключения клиента
+    # Валидный IPv4 (порт после `:` отбрасывается) попадает в группу `ip`, любой другой адрес - в `raw_ip_port`
     # Пример: "... Incoming Conn{db20bbd} on 10.205.6.128:39462 accepted, 2 of 500"
     CONNECTION = re.compile(
-        r".*?Incoming Conn\{(?P<conn_hex_id>[0-9a-f]+)} on (?P<raw_ip_port>\S+) accepted, "
-        r"(?P<open_connections>\d+) of (?P<limit>\d+)"
+        rb"Incoming Conn\{(?P<conn_hex_id>[0-9a-f]+)} on "
+        rb"(?:(?P<ip>" + _IPV4_OCTET + rb"(?:\." + _IPV4_OCTET + rb"){3})(?::\S*)?|(?P<raw_ip_port>\S+)) accepted, "
+        rb"(?P<open_connections>\d+) of (?P<limit>\d+)"
     )
     # Регулярное выражение для строки нового запроса
     # Пример: "... On Conn{db20bbd} new Query{081ad910} [3768519]: синемаскоп"
     NEW_QUERY = re.compile(
-        r".*?On Conn\{(?P<conn_hex_id>[0-9a-f]+)} new Query\{(?P<query_hex_id>[0-9a-f]+)} "
-        r"\[(?P<query_id>\d+)]: (?P<text_decoded>.+)"
+        rb"On Conn\{(?P<conn_hex_id>[0-9a-f]+)} new Query\{(?P<query_hex_id>[0-9a-f]+)} "
+        rb"\[(?P<query_id>\d+)]: (?P<text_decoded>.+)"
     )
     # Регулярное выражение для строки завершения запроса
     # Пример: "... End Query{081ad910} [3768519], done, spent { 0.232496 : 0.018137 queue, 0.21036 work } ms, 21 bytes"
     END = re.compile(
-        r".*?End Query\{(?P<query_hex_id>[0-9a-f]+)} \[(?P<query_id>\d+)], (?P<status>\w+),\s"
-        r"spent \{ (?P<time_total_ms>[\d.]+) : (?P<time_in_queue_ms>[\d.]+) queue, "
-        r"(?P<time_working_ms>[\d.]+) work } ms, (?P<response_size_bytes>\d+) bytes"
+        rb"End Query\{(?P<query_hex_id>[0-9a-f]+)} \[(?P<query_id>\d+)], (?P<status>\w+),\s"
+        rb"spent \{ (?P<time_total_ms>[\d.]+) : (?P<time_in_queue_ms>[\d.]+) queue, "
+        rb"(?P<time_working_ms>[\d.]+) work } ms, (?P<response_size_bytes>\d+) bytes"
     )
-
-    def __init__(self, file_path: Path):
+    # Общее регулярное выражение по литеральным префиксам всех трёх типов строк:
+    # один проход по диапазону файла, тип строки определяется по первому байту совпадения
+    # (без групп захвата, иначе `re` не использует быстрый поиск по первому символу)
+    LINE_KIND = re.compile(rb"Incoming Conn\{|On Conn\{|End Query\{")
+    # Метка времени разбирается у первой, у каждой `TIMESTAMP_SAMPLE_INTERVAL`-й и у последней строки завершения запроса:
+    # лог идёт примерно по времени, а метки нужны только для границ интервала в `rps()`
+    TIMESTAMP_SAMPLE_INTERVAL = 1024
+    # Размер блока при потоковом чтении файлов, которые нельзя отобразить в память
+    READ_BLOCK_SIZE = 1 << 20
+
+    def __init__(self, file_path: Path, dedup: bool = True):
         self.path = file_path
+        # Отбрасывать ли повторные строки с уже встреченным ID запроса
+        # Без дедупликации множества ID не ведутся и не проверяются
+        self.dedup = dedup
 
-        self.connection_to_ip: Dict[str, str] = {}
+        self.connection_to_ip: Dict[bytes, str] = {}
         self.query_to_ip: Dict[int, str] = {}
+        # Только в воркере `parse_parallel`: для каждого ID запроса - подключения (по порядку) тех его строк после
+        # последней сопоставленной, чьё подключение не встретилось в диапазоне; разрешаются в `_merge`
+        # по подключениям из предыдущих диапазонов
+        self._track_pending_queries: bool = False
+        self._pending_query_conns: Dict[int, List[bytes]] = {}
 
-        self.request_freq: Dict[str, int] = {}
+        self.request_freq: Counter[str] = Counter()
         self.total_words: int = 0
+        # Частота сырых (не декодированных) текстов запросов текущего диапазона, см. `_count_requests`
+        self._raw_request_freq: Counter[bytes] = Counter()
 
         self.valid_ips: Set[str] = set()
         self.invalid_ips: Set[str] = set()
 
-        self.first_end_time: Optional[datetime] = None
-        self.last_end_time: Optional[datetime] = None
+        self.first_end_time: Timestamp = NO_FIRST_TIME
+        self.last_end_time: Timestamp = NO_LAST_TIME
+        # Количество строк завершения запроса и границы последней из них в текущем диапазоне
+        self._end_seen: int = 0
+        self._last_end_line: Optional[Tuple[int, int]] = None
 
         self.total_time_working_ms: float = 0.0
         self.total_time_with_waiting_ms: float = 0.0
         self.max_handling_time_working_ms: float = 0.0
         self.max_handling_time_with_waiting_ms: float = 0.0
 
+        self.new_query_count: int = 0
+        self.finished_query_count: int = 0
         self.new_query_ids: Set[int] = set()
         self.finished_query_ids: Set[int] = set()
 
     def parse(self):
         """
-        Построчное чтение и парсинг строк лога
+        Последовательный парсинг всего файла
+        Обычный файл отображается в память; каналы и FIFO (`st_size == 0`, `mmap` невозможен) читаются потоком до конца
         """
-        with self.path.open("r", encoding="utf-8") as f:
-            for line in f:
-                line = line.rstrip("\n")
+        file_stat = self.path.stat()
+        if stat.S_ISREG(file_stat.st_mode):
+            self._parse_range(0, file_stat.st_size)
+        else:
+            self._parse_stream()
 
-                if "Incoming Conn{" in line and self._parse_connection(line):
-                    continue
-                if "On Conn{" in line and self._parse_new_query(line):
-                    continue
-                if "End Query{" in line and self._parse_end_query(line):
-                    continue
+    def parse_parallel(self, n_workers: int):
+        """
+        Параллельный парсинг: файл делится на `n_workers` диапазонов по границам строк,
+        каждый диапазон разбирается в отдельном процессе, результаты объединяются в `self`
+        Доступен только без дедупликации: повторные ID запросов из разных диапазонов нельзя отбросить при объединении
+        Файл, который не является обычным (канал, FIFO), нельзя разделить на диапазоны - он разбирается последовательно
+        """
+        if self.dedup:
+            raise ValueError("параллельный парсинг возможен только без дедупликации (dedup=False)")
+        if not stat.S_ISREG(self.path.stat().st_mode):
+            self.parse()
+            return
+        bounds = self._split_ranges(n_workers)
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            states = pool.map(_parse_file_range, repeat(self.path), bounds[:-1], bounds[1:], repeat(self.dedup))
+            for state in states:
+                self._merge(state)
+
+    def _split_ranges(self, n_parts: int) -> List[int]:
+        """
+        Делит файл на `n_parts` примерно равных диапазонов байт; каждая граница сдвигается на начало следующей строки
+        Возвращает список границ длины `n_parts + 1`
+        """
+        size = self.path.stat().st_size
+        bounds = [0]
+        with self.path.open("rb") as f:
+            for i in range(1, n_parts):
+                f.seek(max(size * i // n_parts, bounds[-1]))
+                f.readline()
+                bounds.append(f.tell())
+        bounds.append(size)
+        return bounds
+
+    def _parse_range(self, start: int, end: int):
+        """
+        Парсинг диапазона [start, end) файла, отображённого в память через `mmap`:
+        поиск идёт прямо по страницам файла без копирования в буферы Python
+        """
+        if start >= end:
+            return
+        with self.path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            self._parse_buffer(buf, start, end)
+            self._flush_last_end_time(buf)
+        self._count_requests()
+
+    def _parse_stream(self):
+        """
+        Потоковое чтение файла до конца блоками по `READ_BLOCK_SIZE` байт
+        Незавершённая последняя строка блока переносится в начало следующего
+        """
+        with self.path.open("rb") as f:
+            tail = b""
+            while True:
+                block = f.read(self.READ_BLOCK_SIZE)
+                if not block:
+                    break
+                block = tail + block
+                cut = block.rfind(b"\n") + 1
+                tail = block[cut:]
+                self._parse_buffer(block, 0, cut)
+                self._flush_last_end_time(block)
+            self._parse_buffer(tail, 0, len(tail))
+            self._flush_last_end_time(tail)
+        self._count_requests()
+
+    def _flush_last_end_time(self, buf: Buffer):
+        """
+        Учитывает метку времени последней строки завершения запроса в `buf`, пока буфер ещё доступен
+        """
+        if self._last_end_line:
+            self._update_end_time(buf, *self._last_end_line)
+            self._last_end_line = None
 
-    def _parse_connection(self, line: str) -> bool:
+    def _count_requests(self):
+        """
+        Переносит частоты сырых текстов запросов в `self.request_freq` и `self.total_words`
+        Тексты в логах часто повторяются, поэтому декодирование и подсчёт слов выполняются один раз на уникальный текст
+        """
+        for raw, n in self._raw_request_freq.items():
+            text_decoded = raw.decode().strip()
+            if text_decoded:
+                self.request_freq[text_decoded] += n
+                self.total_words += n * self._count_words(text_decoded)
+        self._raw_request_freq.clear()
+
+    def _merge(self, state: Dict[str, Any]):
+        """
+        Добавляет к `self` результаты парсинга другого диапазона файла (`vars()` другого парсера)
+        """
+        self.query_to_ip.update(state["query_to_ip"])
+        for query_id, conn_hex_ids in state["_pending_query_conns"].items():
+            # Как при последовательном парсинге: побеждает последняя строка, подключение которой уже известно
+            for conn_hex_id in reversed(conn_hex_ids):
+                ip = self.connection_to_ip.get(conn_hex_id)
+                if ip:
+                    self.query_to_ip[query_id] = ip
+                    break
+        self.connection_to_ip.update(state["connection_to_ip"])
+
+        self.request_freq.update(state["request_freq"])
+        self.total_words += state["total_words"]
+
+        self.valid_ips |= state["valid_ips"]
+        self.invalid_ips |= state["invalid_ips"]
+
+        self.first_end_time = min(self.first_end_time, state["first_end_time"])
+        self.last_end_time = max(self.last_end_time, state["last_end_time"])
+
+        self.total_time_working_ms += state["total_time_working_ms"]
+        self.total_time_with_waiting_ms += state["total_time_with_waiting_ms"]
+        self.max_handling_time_working_ms = max(
+            self.max_handling_time_working_ms, state["max_handling_time_working_ms"]
+        )
+        self.max_handling_time_with_waiting_ms = max(
+            self.max_handling_time_with_waiting_ms, state["max_handling_time_with_waiting_ms"]
+        )
+
+        self.new_query_count += state["new_query_count"]
+        self.finished_query_count += state["finished_query_count"]
+        self.new_query_ids |= state["new_query_ids"]
+        self.finished_query_ids |= state["finished_query_ids"]
+
+    def _parse_buffer(self, buf: Buffer, start: int, end: int):
+        """
+        Ищет литеральные префиксы сразу по всему диапазону [start, end), поэтому строки без них не доходят до Python-кода
+        Парсерам передаётся сам буфер и смещения строки (начало, позиция префикса, конец) - строка не копируется;
+        в каждой строке учитывается только первый префикс
+        """
+        handlers = {
+            ord("I"): self._parse_connection,
+            ord("O"): self._parse_new_query,
+            ord("E"): self._parse_end_query,
+        }
+        find = buf.find
+        rfind = buf.rfind
+        line_end = start
+        for kind in self.LINE_KIND.finditer(buf, start, end):
+            pos = kind.start()
+            if pos < line_end:
+                continue
+            line_start = rfind(b"\n", start, pos) + 1 or start
+            line_end = find(b"\n", pos, end)
+            if line_end == -1:
+                line_end = end
+            if buf[line_end - 1] == 13:  # b"\r"
+                line_end -= 1
+            handlers[buf[pos]](buf, line_start, pos, line_end)
+
+    def _parse_connection(self, buf: Buffer, start: int, pos: int, end: int) -> bool:
         """
         Парсер строки подключения
-        Извлекает ID (hex) подключения и IP-адрес клиента
+        Извлекает ID (hex) подключения и IP-адрес клиента; валидность IP проверяется регулярным выражением
         """
-        match = self.CONNECTION.search(line)
+        match = self.CONNECTION.match(buf, pos, end)
         if not match:
             return False
         conn_hex_id = match.group("conn_hex_id")
-        raw_ip_port = match.group("raw_ip_port")
-        ip = self._extract_ip(raw_ip_port)
+        ip = match.group("ip")
         if ip:
+            ip = ip.decode()
             self.valid_ips.add(ip)
-            self.connection_to_ip[conn_hex_id] = ip
         else:
-            self.invalid_ips.add(raw_ip_port)
-            self.connection_to_ip[conn_hex_id] = raw_ip_port
+            ip = match.group("raw_ip_port").decode()
+            self.invalid_ips.add(ip)
+        self.connection_to_ip[conn_hex_id] = ip
         return True
 
-    def _parse_new_query(self, line: str) -> bool:
+    def _parse_new_query(self, buf: Buffer, start: int, pos: int, end: int) -> bool:
         """
         Парсер строки нового запроса
-        Пропускает дубликаты (если есть), обновляет частоту запросов (`self.request_freq`) и суммарное количество слов в запросах (`self.total_words`)
+        Пропускает дубликаты (если есть), обновляет частоту сырых текстов запросов (`self._raw_request_freq`)
         """
-        match = self.NEW_QUERY.search(line)
+        match = self.NEW_QUERY.match(buf, pos, end)
         if not match:
             return False
         query_id = int(match.group("query_id"))
 
-        if query_id in self.new_query_ids:
-            return True
-
-        self.new_query_ids.add(query_id)
-        text_decoded = match.group("text_decoded").strip()
+        if self.dedup:
+            if query_id in self.new_query_ids:
+                return True
+            self.new_query_ids.add(query_id)
+        self.new_query_count += 1
 
         conn_hex_id = match.group("conn_hex_id")
         ip = self.connection_to_ip.get(conn_hex_id)
         if ip:
             self.query_to_ip[query_id] = ip
+            if self._track_pending_queries:
+                self._pending_query_conns.pop(query_id, None)
+        elif self._track_pending_queries:
+            self._pending_query_conns.setdefault(query_id, []).append(conn_hex_id)
 
-        if text_decoded:
-            self.request_freq[text_decoded] = self.request_freq.get(text_decoded, 0) + 1
-            self.total_words += len(text_decoded.split())
+        self._raw_request_freq[match.group("text_decoded")] += 1
 
         return True
 
-    def _parse_end_query(self, line: str) -> bool:
+    def _parse_end_query(self, buf: Buffer, start: int, pos: int, end: int) -> bool:
         """
         Парсер строки завершения запроса
         Извлекает времена: обработки запроса, ожидания в очереди, общее время обработки; обновляет максимальное время обработки
         """
-        match = self.END.search(line)
+        match = self.END.match(buf, pos, end)
         if not match:
             return False
-
         query_id = int(match.group("query_id"))
-        if query_id in self.finished_query_ids:
-            return True
-
-        self.finished_query_ids.add(query_id)
-
         time_total_ms = float(match.group("time_total_ms"))
         time_working_ms = float(match.group("time_working_ms"))
 
+        if self.dedup:
+            if query_id in self.finished_query_ids:
+                return True
+            self.finished_query_ids.add(query_id)
+        self.finished_query_count += 1
+
         self.total_time_with_waiting_ms += time_total_ms
         self.total_time_working_ms += time_working_ms
 
@@ -139,26 +322,33 @@ class Parser:
         if time_working_ms > self.max_handling_time_working_ms:
             self.max_handling_time_working_ms = time_working_ms
 
-        ts = self._extract_internal_timestamp(line)
-        if ts:
-            if self.first_end_time is None or ts < self.first_end_time:
-                self.first_end_time = ts
-            if self.last_end_time is None or ts > self.last_end_time:
-                self.last_end_time = ts
+        if self._end_seen % self.TIMESTAMP_SAMPLE_INTERVAL == 0:
+            self._update_end_time(buf, start, end)
+        self._end_seen += 1
+        self._last_end_line = (start, end)
 
         return True
 
-    def most_popular_request(self) -> Optional[str]:
+    def _update_end_time(self, buf: Buffer, start: int, end: int):
+        """
+        Обновляет первую и последнюю метку времени по строке завершения запроса `buf[start:end]`
+        """
+        ts = self._extract_internal_timestamp(buf, start, end)
+        if ts:
+            self.first_end_time = ts if ts < self.first_end_time else self.first_end_time
+            self.last_end_time = ts if ts > self.last_end_time else self.last_end_time
+
+    def most_popular_request(self) -> Optional[Tuple[str, int]]:
         if not self.request_freq:
             return None
-        return max(self.request_freq.items(), key=lambda kv: kv[1])[0]
+        return self.request_freq.most_common(1)[0]
 
     def average_words(self) -> float:
-        n = len(self.new_query_ids)
+        n = self.new_query_count
         return self.total_words / n if n else 0.0
 
     def average_times(self) -> Tuple[float, float]:
-        c = len(self.finished_query_ids)
+        c = self.finished_query_count
         if c == 0:
             return 0.0, 0.0
         return self.total_time_working_ms / c, self.total_time_with_waiting_ms / c
@@ -167,44 +357,61 @@ class Parser:
         return self.max_handling_time_working_ms, self.max_handling_time_with_waiting_ms
 
     def rps(self) -> float:
-        c = len(self.finished_query_ids)
-        if c == 0 or not self.first_end_time or not self.last_end_time:
+        c = self.finished_query_count
+        if c == 0 or self.last_end_time == NO_LAST_TIME:
             return 0.0
-        span = (self.last_end_time - self.first_end_time).total_seconds()
+        span = (self._to_datetime(self.last_end_time) - self._to_datetime(self.first_end_time)).total_seconds()
         if span <= 0:
             return float(c)
         return c / span
 
-    def _extract_internal_timestamp(self, line: str) -> Optional[datetime]:
+    @staticmethod
+    def _count_words(text: str) -> int:
         """
-        Извлекает внутреннюю метку времени формата [dd.mm.yy hh:mm:ss]
+        Считает слова в непустом тексте без краевых пробелов подсчётом пробелов, без построения списка через `split()`
+        Если в тексте есть двойные пробелы или другие пробельные символы (они не печатаемые), считает через `split()`
         """
-        match = self.INTERNAL_TIMESTAMP.search(line)
-        if not match:
-            return None
-        dd, mm, yy, hms = match.groups()
-        return datetime.strptime(f"20{yy}-{mm}-{dd} {hms}", "%Y-%m-%d %H:%M:%S")
+        if "  " in text or not text.isprintable():
+            return len(text.split())
+        return text.count(" ") + 1
 
-    def _extract_ip(self, raw: str) -> Optional[str]:
+    @staticmethod
+    def _extract_internal_timestamp(buf: Buffer, start: int, end: int) -> Optional[Timestamp]:
         """
-        Пытается извлечь валидный IPv4 адрес из строки. Если IP невалидный, то возвращает `raw`
+        Извлекает внутреннюю метку времени формата [dd.mm.yy hh:mm:ss] из строки `buf[start:end]` разбором по фиксированным позициям
         """
-        if ":" in raw:
-            ip = raw.split(":", 1)[0]
-            if self._is_valid_ipv4(ip):
-                return ip
-        else:
-            if self._is_valid_ipv4(raw):
-                return raw
+        p = buf.find(b"[", start, end)
+        while p != -1:
+            ts = buf[p + 1:p + 18]
+            if (
+                p + 19 <= end
+                and buf[p + 18:p + 19] == b"]"
+                and ts[2:3] == b"." and ts[5:6] == b"." and ts[8:9] == b" " and ts[11:12] == b":" and ts[14:15] == b":"
+            ):
+                digits = ts[6:8] + ts[3:5] + ts[0:2] + ts[9:11] + ts[12:14] + ts[15:17]
+                if digits.isdigit():
+                    return int(digits)
+            p = buf.find(b"[", p + 1, end)
         return None
 
     @staticmethod
-    def _is_valid_ipv4(raw: str) -> bool:
+    def _to_datetime(ts: Timestamp) -> datetime:
         """
-        Валидирует IPv4 через `ipaddress.IPv4Address`
+        Переводит внутреннюю метку времени в `datetime`
         """
-        try:
-            IPv4Address(raw)
-            return True
-        except ValueError:
-            return False
+        rest, ss = divmod(ts, 100)
+        rest, mi = divmod(rest, 100)
+        rest, hh = divmod(rest, 100)
+        rest, dd = divmod(rest, 100)
+        yy, mm = divmod(rest, 100)
+        return datetime(2000 + yy, mm, dd, hh, mi, ss)
+
+
+def _parse_file_range(path: Path, start: int, end: int, dedup: bool) -> Dict[str, Any]:
+    """
+    Разбирает диапазон [start, end) файла в процессе-воркере и возвращает состояние парсера для `Parser._merge`
+    """
+    parser = Parser(path, dedup=dedup)
+    parser._track_pending_queries = True
+    parser._parse_range(start, end)
+    return vars(parser)